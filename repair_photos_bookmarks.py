@@ -5,6 +5,9 @@ Thanks to David Gleich (@dgleich, https://github.com/dgleich) who contributed ke
 
 from __future__ import annotations
 
+import concurrent.futures
+import contextlib
+import hashlib
 import itertools
 import os
 import pathlib
@@ -14,14 +17,26 @@ import subprocess
 import sys
 import time
 import uuid
-from collections import namedtuple
+from collections import OrderedDict, defaultdict, deque, namedtuple
 from functools import lru_cache
-from typing import Dict, List, Optional, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import click
-import photokit
 from mac_alias import Bookmark, kBookmarkPath
-from photoscript import PhotosLibrary
+
+# objc, AppKit, Foundation, photokit and photoscript are imported in the functions that use them
+# so the worker processes that resolve bookmarks don't load the Cocoa bridges when they import this module
+if TYPE_CHECKING:
+    from photoscript import PhotosLibrary
 
 # TODO: check the import group logic
 
@@ -36,16 +51,38 @@ TEMP_LIBRARY_SENTINEL_ALBUM = "XYZZY_OSXPHOTOS_SENTINEL_XYZZY"
 SLEEP_TIME_AFTER_QUIT = 5
 SLEEP_TIME_AFTER_ACTIVATE = 10
 
-# seconds to sleep after importing a group of files
+# max seconds to wait after importing a group of files
 # gives Photos time to process the import and AppleScript time to not choke
+# the wait ends early once the imported files show up in the temporary library
 SLEEP_TIME_AFTER_IMPORT = 0.25
 
+# max number of threads to use for moving AAE files
+RENAME_MAX_WORKERS = 8
+
+# resolve bookmarks in worker processes once there are at least this many
+# below this, the cost of starting the workers outweighs the parallel speedup
+RESOLVE_BOOKMARKS_PARALLEL_THRESHOLD = 2000
+RESOLVE_BOOKMARKS_CHUNKSIZE = 256
+
+# max number of resolved bookmark paths to cache; the cache only holds a digest of each bookmark
+# and its path so this is a few MB at most
+RESOLVE_BOOKMARKS_CACHE_SIZE = 65536
+_resolved_bookmark_paths: OrderedDict[bytes, Optional[str]] = OrderedDict()
+
+PHOTOS_BUNDLE_ID = "com.apple.Photos"
+
 # namedtuple to hold the data from the ZFILESYSTEMBOOKMARK table
 ZFileSystemBookmarkRecord = namedtuple(
     "ZFileSystemBookmarkRecord",
     ["pk", "volume_name", "volume_uuid", "path_relative_to_volume", "bookmark_data"],
 )
 
+# cached listing of a directory: set of file names and dict of file names by lower case name
+DirectoryEntries = namedtuple("DirectoryEntries", ["names", "names_by_lower"])
+
+# a Photos database: either the path to the database or a connection from open_sqlite_db
+PhotosDB = Union[str, pathlib.Path, sqlite3.Connection]
+
 
 def get_temp_photos_library_dir() -> pathlib.Path:
     """Get the path to the hold temporary photos library"""
@@ -70,6 +107,8 @@ def create_or_get_temporary_photos_library():
     timestamp = time.perf_counter_ns()
     temp_library_path = dest / f"{TEMPLATE_LIBRARY}_{timestamp}.photoslibrary"
     if not temp_library_path.exists():
+        import photokit
+
         pl = photokit.PhotoLibrary.create_library(str(temp_library_path))
         pl.create_album(TEMP_LIBRARY_SENTINEL_ALBUM)
     return temp_library_path
@@ -77,22 +116,35 @@ def create_or_get_temporary_photos_library():
 
 def photos_is_running() -> bool:
     """Returns True if current user is running Photos, otherwise False"""
-    # Note: use subprocess because psutil doesn't work on M1 Macs (see #3)
-    user_name = subprocess.check_output(["id", "-un"]).decode("utf-8").strip()
-    output = (
-        subprocess.check_output(["ps", "-ax", "-o", "user", "-o", "command"])
-        .decode("utf-8")
-        .splitlines()
-    )
-    return any(
-        proc[0] == user_name and "Photos.app" in proc[1]
-        for proc in [line.split(" ", 1) for line in output]
+    from AppKit import NSRunningApplication
+
+    # only returns apps for the current user
+    return bool(
+        NSRunningApplication.runningApplicationsWithBundleIdentifier_(PHOTOS_BUNDLE_ID)
     )
 
 
-@lru_cache
+@lru_cache(maxsize=None)
 def get_volume_uuid(path: str) -> str:
-    """Returns the volume UUID for the given path or None if not found"""
+    """Returns the volume UUID for the given path or None if not found
+
+    Results are cached for the life of the process as there are only a handful of distinct volumes
+    and a lookup may have to fall back to running diskutil.
+    """
+    # ask Foundation directly; resolve symlinks first so /Volumes/<boot volume name> gives
+    # the UUID of / the same as diskutil does rather than that of the volume holding the link
+    # the pool releases the Foundation objects right away; this also runs on the worker
+    # threads in prime_volume_uuid_cache which have no pool of their own
+    import objc
+    from Foundation import NSURL, NSURLVolumeUUIDStringKey
+
+    with objc.autorelease_pool():
+        url = NSURL.fileURLWithPath_(path).URLByResolvingSymlinksInPath()
+        ok, volume_uuid, _ = url.getResourceValue_forKey_error_(
+            None, NSURLVolumeUUIDStringKey, None
+        )
+        if ok and volume_uuid:
+            return str(volume_uuid)
     try:
         output = subprocess.check_output(["diskutil", "info", "-plist", path])
         plist = plistlib.loads(output)
@@ -101,22 +153,86 @@ def get_volume_uuid(path: str) -> str:
         return None
 
 
-def open_sqlite_db(fname: str) -> tuple[sqlite3.Connection, sqlite3.Cursor]:
-    """Open sqlite database and return connection to the database"""
+def prime_volume_uuid_cache(photos_db_path: PhotosDB):
+    """Populate the get_volume_uuid cache for the root volume and every volume referenced
+    in the Photos database so later lookups don't each wait on a diskutil subprocess"""
+    volume_paths = {"/"} | {
+        f"/Volumes/{volume['ZNAME']}"
+        for volume in read_zfilesystemvolume_data(photos_db_path).values()
+        if volume["ZNAME"]
+    }
+    # diskutil calls are independent so run them concurrently
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        list(executor.map(get_volume_uuid, volume_paths))
+
+
+def open_sqlite_db(
+    fname: str, read_only: bool = False
+) -> tuple[sqlite3.Connection, sqlite3.Cursor]:
+    """Open sqlite database and return connection to the database
+
+    If read_only is True, the database is opened with mode=ro so the connection can never write to it.
+    """
     try:
-        conn = sqlite3.connect(f"{fname}")
+        if read_only:
+            # not immutable=1: Photos may still be writing to the database while we read it
+            conn = sqlite3.connect(
+                f"{pathlib.Path(fname).absolute().as_uri()}?mode=ro", uri=True
+            )
+        else:
+            conn = sqlite3.connect(f"{fname}")
         c = conn.cursor()
+        if not read_only:
+            # Photos already uses WAL; NORMAL sync is safe in WAL mode and avoids an fsync per commit
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+        # 64MB page cache and in-memory temp tables; connections may be kept open for the whole run
+        c.execute("PRAGMA cache_size=-65536")
+        c.execute("PRAGMA temp_store=MEMORY")
+        # memory map up to 256MB of the database so reads skip the read() syscall and copy
+        c.execute("PRAGMA mmap_size=268435456")
     except sqlite3.Error as e:
         raise OSError(f"Error opening {fname}: {e}") from e
     return (conn, c)
 
 
+@contextlib.contextmanager
+def photos_db_connection(
+    photos_db: PhotosDB,
+) -> Iterator[Tuple[sqlite3.Connection, sqlite3.Cursor]]:
+    """Context manager that yields (connection, cursor) for photos_db
+
+    photos_db may be the path to the database, in which case the database is opened and then closed on exit,
+    or an already open connection which is used as is and left open.
+    """
+    if isinstance(photos_db, sqlite3.Connection):
+        yield (photos_db, photos_db.cursor())
+        return
+    conn, c = open_sqlite_db(photos_db)
+    try:
+        yield (conn, c)
+    finally:
+        conn.close()
+
+
+def _photos_db_cache_key(photos_db: PhotosDB) -> Union[str, sqlite3.Connection]:
+    """Return hashable key for photos_db for use with lru_cache"""
+    return photos_db if isinstance(photos_db, sqlite3.Connection) else str(photos_db)
+
+
 def get_path_from_zfilesystembookmark_record(record: ZFileSystemBookmarkRecord) -> str:
     """Get path from a ZFILESYSTEMBOOKMARK record, either by resolving the bookmark or trying to reconstruct the path"""
     if bookmark_data := record.bookmark_data:
         return resolve_bookmark_path(bookmark_data)
 
     # if we don't have a bookmark, we can reconstruct the path
+    return reconstruct_path_from_zfilesystembookmark_record(record)
+
+
+def reconstruct_path_from_zfilesystembookmark_record(
+    record: ZFileSystemBookmarkRecord,
+) -> str:
+    """Reconstruct the path of a ZFILESYSTEMBOOKMARK record from its volume name and path relative to the volume"""
     # don't add the mount point if it's on the root volume
     # e.g. Photos expects paths on root volumes to be in form
     # /Users/username/Pictures/img_1234.jpg
@@ -133,7 +249,34 @@ def resolve_bookmark_path(bookmark_data: bytes) -> str:
     """Get the path from a CFURL file bookmark
     This works without calling CFURLCreateByResolvingBookmarkData
     which fails if the target file does not exist
+
+    Results are cached as the same bookmark data is resolved by more than one step of the repair.
+    The cache is keyed on bookmark_digest(bookmark_data) so it doesn't keep the bookmark data alive.
     """
+    digest = bookmark_digest(bookmark_data)
+    if digest in _resolved_bookmark_paths:
+        _resolved_bookmark_paths.move_to_end(digest)
+        return _resolved_bookmark_paths[digest]
+    path = parse_bookmark_path(bookmark_data)
+    cache_resolved_bookmark_path(digest, path)
+    return path
+
+
+def bookmark_digest(bookmark_data: bytes) -> bytes:
+    """Return the key for bookmark_data in the resolved bookmark path cache"""
+    return hashlib.blake2b(bookmark_data, digest_size=16).digest()
+
+
+def cache_resolved_bookmark_path(digest: bytes, path: Optional[str]):
+    """Add path to the resolved bookmark path cache for the bookmark with digest, dropping the least recently used path if full"""
+    _resolved_bookmark_paths[digest] = path
+    _resolved_bookmark_paths.move_to_end(digest)
+    if len(_resolved_bookmark_paths) > RESOLVE_BOOKMARKS_CACHE_SIZE:
+        _resolved_bookmark_paths.popitem(last=False)
+
+
+def parse_bookmark_path(bookmark_data: bytes) -> Optional[str]:
+    """Parse the path from a CFURL file bookmark without using the resolved bookmark path cache"""
     try:
         bookmark = Bookmark.from_bytes(bookmark_data)
     except Exception as e:
@@ -141,28 +284,117 @@ def resolve_bookmark_path(bookmark_data: bytes) -> str:
     path_components = bookmark.get(kBookmarkPath, None)
     if not path_components:
         return None
-    return f"/{os.path.join(*path_components)}"
+    return "/" + "/".join(path_components)
 
 
-def read_file_locations_from_photos_database(photos_db_path: str) -> Dict:
+def read_file_locations_from_photos_database(photos_db_path: PhotosDB) -> Dict:
     """Read locations for referenced files from Photos database, returns dict of file paths by pk"""
-    referenced_files = {}
-    results = read_zfilesystembookmark_from_photos_database(photos_db_path)
-    for result in results:
-        try:
-            bookmark_path = get_path_from_zfilesystembookmark_record(result)
-            referenced_files[result.pk] = bookmark_path
-            if _verbose > 2:
-                click.secho(f"... will import path '{bookmark_path}'", fg="green")
-        except ValueError as e:
+    referenced_files = records_to_paths(
+        iter_zfilesystembookmark_from_photos_database(photos_db_path)
+    )
+    if _verbose > 2:
+        for bookmark_path in referenced_files.values():
+            click.secho(f"... will import path '{bookmark_path}'", fg="green")
+    return referenced_files
+
+
+def records_to_paths(records: Iterable[ZFileSystemBookmarkRecord]) -> Dict[int, str]:
+    """Return dict of file paths by pk for ZFILESYSTEMBOOKMARK records, skipping any that can't be resolved"""
+    paths = {}
+    for record, path, error in resolve_record_paths(records):
+        if error is None:
+            paths[record.pk] = path
+        else:
             # if the file is missing, we can't resolve the bookmark
             # TODO: need to change the logic here now that get_path_from_zfilesystembookmark_record will attempt to reconstruct the path
             click.secho(
-                f"Skipping missing file '{result.path_relative_to_volume}', cannot resolve bookmarks for missing files.",
+                f"Skipping missing file '{record.path_relative_to_volume}', cannot resolve bookmarks for missing files.",
                 err=True,
                 fg="red",
             )
-    return referenced_files
+    return paths
+
+
+def resolve_record_paths(
+    records: Iterable[ZFileSystemBookmarkRecord],
+) -> Iterator[Tuple[ZFileSystemBookmarkRecord, Optional[str], Optional[str]]]:
+    """Resolve the path for each record, yields (record, path, error) in the same order as records
+
+    Parsing bookmarks is CPU bound so for large libraries it is spread across worker processes.
+    The first RESOLVE_BOOKMARKS_PARALLEL_THRESHOLD records decide whether the workers are used;
+    records are then streamed to them a chunk at a time with only a few chunks in flight so the
+    whole table is never held in memory. Records resolved by the workers are yielded without their
+    bookmark_data and their paths are added to this process's resolved bookmark path cache.
+    """
+    records = iter(records)
+    prefix = list(itertools.islice(records, RESOLVE_BOOKMARKS_PARALLEL_THRESHOLD))
+    if len(prefix) < RESOLVE_BOOKMARKS_PARALLEL_THRESHOLD:
+        for record in prefix:
+            yield (record, *_resolve_record_path(record))
+        return
+
+    records = itertools.chain(prefix, records)
+    max_workers = os.cpu_count() or 1
+    pending = deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while chunk := list(itertools.islice(records, RESOLVE_BOOKMARKS_CHUNKSIZE)):
+            future = executor.submit(
+                _parse_bookmark_paths, [record.bookmark_data for record in chunk]
+            )
+            # keep only what's needed to report and cache the results, not the bookmarks
+            digests = [
+                bookmark_digest(record.bookmark_data) if record.bookmark_data else None
+                for record in chunk
+            ]
+            chunk = [record._replace(bookmark_data=None) for record in chunk]
+            pending.append((chunk, digests, future))
+            # enough chunks queued to keep every worker busy
+            if len(pending) > 2 * max_workers:
+                yield from _collect_resolved_record_paths(*pending.popleft())
+        while pending:
+            yield from _collect_resolved_record_paths(*pending.popleft())
+
+
+def _collect_resolved_record_paths(
+    records: List[ZFileSystemBookmarkRecord],
+    digests: List[Optional[bytes]],
+    future: concurrent.futures.Future,
+) -> Iterator[Tuple[ZFileSystemBookmarkRecord, Optional[str], Optional[str]]]:
+    """Yield (record, path, error) for a chunk of records whose bookmarks were parsed by _parse_bookmark_paths in a worker process"""
+    for record, digest, (path, error) in zip(records, digests, future.result()):
+        if digest is None:
+            # no bookmark data; reconstructing the path needs get_volume_uuid which is cached in this process
+            path, error = _resolve_record_path(record)
+        elif error is None:
+            cache_resolved_bookmark_path(digest, path)
+        yield (record, path, error)
+
+
+def _resolve_record_path(
+    record: ZFileSystemBookmarkRecord,
+) -> Tuple[Optional[str], Optional[str]]:
+    """Return (path, None) for record or (None, error) if the path can't be resolved"""
+    try:
+        return get_path_from_zfilesystembookmark_record(record), None
+    except ValueError as e:
+        return None, str(e)
+
+
+def _parse_bookmark_paths(
+    bookmarks: List[Optional[bytes]],
+) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Return (path, error) for each bookmark, (None, None) where there is no bookmark data; runs in a worker process
+
+    Bookmarks are parsed without the resolved bookmark path cache as the parent process caches the results.
+    """
+    results = []
+    for bookmark_data in bookmarks:
+        try:
+            path = parse_bookmark_path(bookmark_data) if bookmark_data else None
+            results.append((path, None))
+        except ValueError as e:
+            results.append((None, str(e)))
+    return results
 
 
 def import_file_to_photos(filepath):
@@ -170,9 +402,17 @@ def import_file_to_photos(filepath):
     import_files_to_photos([filepath])
 
 
+@lru_cache(maxsize=None)
+def get_photos_library() -> PhotosLibrary:
+    """Return a PhotosLibrary instance shared by all calls so the AppleScript setup is only done once"""
+    from photoscript import PhotosLibrary
+
+    return PhotosLibrary()
+
+
 def import_files_to_photos(filepaths):
     """import a file into Photos"""
-    pl = PhotosLibrary()
+    pl = get_photos_library()
     if _verbose > 2:
         click.secho(f"... doing import of ", fg="green")
         for filepath in filepaths:
@@ -180,67 +420,93 @@ def import_files_to_photos(filepaths):
     pl.import_photos(list(filepaths), skip_duplicate_check=True)
 
 
-def read_zfilesystembookmark_from_photos_database(
-    photos_db_path: str,
-) -> List[ZFileSystemBookmarkRecord]:
-    """Dump the main useful contents of the ZFILESYSTEMBOOKMARK table.
-    This returns a namedtuple with keys of: pk, volume_name, volume_uuid, path_relative_to_volume, and bookmark_data
-    """
-    conn, c = open_sqlite_db(photos_db_path)
-    c.execute(
-        """ SELECT
-            ZFILESYSTEMBOOKMARK.Z_PK, 
-            ZFILESYSTEMVOLUME.ZNAME, 
-            ZFILESYSTEMVOLUME.ZVOLUMEUUIDSTRING, 
-            ZFILESYSTEMBOOKMARK.ZPATHRELATIVETOVOLUME, 
-            ZFILESYSTEMBOOKMARK.ZBOOKMARKDATA
-        FROM ZFILESYSTEMBOOKMARK
-        JOIN ZINTERNALRESOURCE ON ZINTERNALRESOURCE.ZFILESYSTEMBOOKMARK = ZFILESYSTEMBOOKMARK.Z_PK
-        JOIN ZFILESYSTEMVOLUME ON ZFILESYSTEMVOLUME.Z_PK = ZINTERNALRESOURCE.ZFILESYSTEMVOLUME
+def count_zfilesystembookmark_records(photos_db_path: PhotosDB) -> int:
+    """Return number of records in the ZFILESYSTEMBOOKMARK table"""
+    with photos_db_connection(photos_db_path) as (conn, c):
+        return c.execute("SELECT COUNT(*) FROM ZFILESYSTEMBOOKMARK").fetchone()[0]
+
+
+def wait_for_photos_import(
+    photos_db_path: PhotosDB, expected_count: int, timeout: float
+):
+    """Wait until Photos has written expected_count records to ZFILESYSTEMBOOKMARK
+    or timeout seconds have elapsed, whichever comes first"""
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    while count_zfilesystembookmark_records(photos_db_path) < expected_count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(delay, remaining))
+        delay *= 2
+
+
+def iter_zfilesystembookmark_from_photos_database(
+    photos_db_path: PhotosDB,
+) -> Iterator[ZFileSystemBookmarkRecord]:
+    """Yield the main useful contents of the ZFILESYSTEMBOOKMARK table one record at a time.
+    Each record is a namedtuple with keys of: pk, volume_name, volume_uuid, path_relative_to_volume, and bookmark_data
     """
-    )
-    results = []
-    for row in c:
-        pk = row[0]
-        volume_name = row[1]
-        volume_uuid = row[2]
-        pathstr = row[3]
-        bookmark_data = row[4]
-        results.append(
-            ZFileSystemBookmarkRecord(
-                pk, volume_name, volume_uuid, pathstr, bookmark_data
-            )
+    with photos_db_connection(photos_db_path) as (conn, c):
+        # Photos already indexes ZINTERNALRESOURCE.ZFILESYSTEMBOOKMARK and ZINTERNALRESOURCE.ZFILESYSTEMVOLUME
+        # so this is a single scan of ZINTERNALRESOURCE with primary key lookups into the other tables;
+        # don't add indexes of our own to the Photos database schema
+        c.execute(
+            """ SELECT
+                ZFILESYSTEMBOOKMARK.Z_PK, 
+                ZFILESYSTEMVOLUME.ZNAME, 
+                ZFILESYSTEMVOLUME.ZVOLUMEUUIDSTRING, 
+                ZFILESYSTEMBOOKMARK.ZPATHRELATIVETOVOLUME, 
+                ZFILESYSTEMBOOKMARK.ZBOOKMARKDATA
+            FROM ZFILESYSTEMBOOKMARK
+            JOIN ZINTERNALRESOURCE ON ZINTERNALRESOURCE.ZFILESYSTEMBOOKMARK = ZFILESYSTEMBOOKMARK.Z_PK
+            JOIN ZFILESYSTEMVOLUME ON ZFILESYSTEMVOLUME.Z_PK = ZINTERNALRESOURCE.ZFILESYSTEMVOLUME
+        """
         )
-    conn.close()
-    return results
+        yield from map(ZFileSystemBookmarkRecord._make, c)
 
 
-def get_bookmark_data_by_path(db_path) -> Dict:
-    """Returns a dict of bookmark data by path"""
-    results = read_zfilesystembookmark_from_photos_database(db_path)
+def get_bookmark_data_by_path(db_path: PhotosDB, paths: Optional[set] = None) -> Dict:
+    """Returns a dict of bookmark data by path; if paths is passed, only bookmarks for those paths are returned"""
     bookmarks_by_path = {}
-    for result in results:
+    for result in iter_zfilesystembookmark_from_photos_database(db_path):
         # resolve the bookmark data
         bookmark_data = result.bookmark_data
         if bookmark_data:
-            filepath = resolve_bookmark_path(bookmark_data)
+            # the path Photos recorded for a freshly imported file is usually the one we're looking for
+            # so only parse the bookmark (the expensive part) if that doesn't match
+            filepath = None
+            if paths is not None and result.path_relative_to_volume:
+                filepath = reconstruct_path_from_zfilesystembookmark_record(result)
+                if filepath not in paths:
+                    filepath = None
+            if filepath is None:
+                filepath = resolve_bookmark_path(bookmark_data)
         else:
             # if bookmark data is missing, try to reconstruct the path
             filepath = f"{result.volume_name}/{result.path_relative_to_volume}"
         if filepath:
-            bookmarks_by_path[filepath] = bookmark_data
+            if paths is None or filepath in paths:
+                bookmarks_by_path[filepath] = bookmark_data
         else:
             click.secho(f"Could not resolve bookmark for {result}", fg="red", err=True)
     return bookmarks_by_path
 
 
 def update_bookmarks_in_photos_database(
-    referenced_files, photos_db_path, import_db_path
+    referenced_files,
+    photos_db_path: PhotosDB,
+    import_db_path: PhotosDB,
+    referenced_paths: Optional[set] = None,
 ):
-    """Update bookmarks for referenced files in a Photos library database"""
-    new_bookmarks = get_bookmark_data_by_path(import_db_path)
-    # update each bookmark in the database
-    (conn, c) = open_sqlite_db(photos_db_path)
+    """Update bookmarks for referenced files in a Photos library database
+
+    referenced_paths is the set of paths in referenced_files; it is computed if not passed.
+    """
+    if referenced_paths is None:
+        referenced_paths = set(referenced_files.values())
+    # only keep the bookmarks we need as the records are streamed from the database
+    new_bookmarks = get_bookmark_data_by_path(import_db_path, referenced_paths)
     updated_paths = set()
     for pk, filepath in referenced_files.items():
         if _verbose > 0:
@@ -252,42 +518,42 @@ def update_bookmarks_in_photos_database(
                 f"File '{filepath}' is not in ZFILESYSTEMBOOKMARK", fg="red", err=True
             )
         else:
-            bookmark_data = new_bookmarks[filepath]
-            conn.execute(
+            updated_paths.add(filepath)
+
+    # update all the bookmarks in the database in a single transaction
+    params = [
+        (new_bookmarks[filepath], pk)
+        for pk, filepath in referenced_files.items()
+        if filepath in new_bookmarks
+    ]
+    with photos_db_connection(photos_db_path) as (conn, c):
+        # take the write lock up front so we fail before doing any work if the database is busy
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            c.executemany(
                 "UPDATE ZFILESYSTEMBOOKMARK SET ZBOOKMARKDATA = ? WHERE Z_PK = ?",
-                (bytes(bookmark_data), pk),
+                params,
             )
-            updated_paths.add(filepath)
+
     if _verbose > 0:
-        missing = set(referenced_files.values()).difference(updated_paths)
+        missing = referenced_paths - updated_paths
         for pathstr in missing:
             click.secho(f"File '{pathstr}' was not updated", fg="yellow", err=True)
         if not missing:
             click.secho("All files were updated")
-    conn.commit()
-    conn.close()
 
 
-def get_previously_imported_filepaths(photos_db_path):
-    results = read_zfilesystembookmark_from_photos_database(photos_db_path)
-    allpaths = set()
-    for result in results:
-        fullpath = get_path_from_zfilesystembookmark_record(result)
-        allpaths.add(fullpath)
-    return allpaths
+def get_previously_imported_filepaths(photos_db_path: PhotosDB):
+    return set(
+        records_to_paths(
+            iter_zfilesystembookmark_from_photos_database(photos_db_path)
+        ).values()
+    )
 
 
-def chunk_iterable(n, iterable):
-    """Yield successive n-sized chunks from iterable."""
-    # reference: https://stackoverflow.com/questions/8991506/iterate-an-iterator-by-chunks-of-n-in-python
-    it = iter(iterable)
-    while True:
-        chunk_it = itertools.islice(it, n)
-        try:
-            first_el = next(chunk_it)
-        except StopIteration:
-            return
-        yield itertools.chain((first_el,), chunk_it)
+def chunked(seq, n):
+    """Return generator of successive n-sized slices of sequence seq."""
+    return (seq[i : i + n] for i in range(0, len(seq), n))
 
 
 def filename_parts_from_filepath(filepath):
@@ -295,8 +561,9 @@ def filename_parts_from_filepath(filepath):
     IMG_2212.JPG, IMG_2212.MOV, IMG_2212.AAE, IMG_E2212.JPG IMG_O2212.JPG
     all should be imported as a group."""
     # The simplest algorithm is just to pick off the last 4 characters and use that...
-    path, filename = os.path.split(filepath)
-    basename, ext = os.path.splitext(filename)
+    # (str.rpartition is used instead of os.path.split/splitext as this is called for every file)
+    path, _, filename = filepath.rpartition("/")
+    basename = filename.rpartition(".")[0] or filename
     # remove the IMG_ prefix.
     last4 = basename[-4:]  # last four digits
     return (path, last4)
@@ -304,179 +571,312 @@ def filename_parts_from_filepath(filepath):
 
 def group_filepaths(filepaths):
     """This takes a list of filepaths and returns all the groups."""
-    keyfunc = filename_parts_from_filepath
-    gsorted = sorted(filepaths, key=keyfunc)
-    return [list(g) for k, g in itertools.groupby(gsorted, keyfunc)]
+    groups = defaultdict(list)
+    for filepath in filepaths:
+        groups[filename_parts_from_filepath(filepath)].append(filepath)
+    return list(groups.values())
 
 
 def already_all_imported(group, imported_filepaths):
     """Test is all the filepaths in groups are already imported in
     imported_filepaths"""
-    nimported = sum(fp in imported_filepaths for fp in group)
-    return nimported == len(group)
+    return all(fp in imported_filepaths for fp in group)
 
 
 def make_import_groups(filepaths, imported_filepaths):
     """Group files and find all the groups where at least one file isn't imported."""
     groups = group_filepaths(filepaths)
+    if not imported_filepaths:
+        # nothing imported yet (first run) so every group needs importing
+        return iter(groups)
     check_group = lambda group: not already_all_imported(group, imported_filepaths)
     return filter(check_group, groups)
 
 
-def move_aae_file_if_it_exists(
+def find_aae_file_to_move(
     filepath: str, do_not_move_set: bool = None
 ) -> Optional[Tuple[str, str]]:
-    """Check if an AAE file exists for this file path, if so, we move it to an AAE.bak file,
-    and return the pair of original AAE file path and moved file path. If the AAE file does not
-    exist, return None"""
-
-    # check upper and lowercase aae extensions
-    # make sure file path exists
-    test_exts = [".AAE", ".aae"]
-    if os.path.exists(filepath):
-        basename, ext = os.path.splitext(filepath)
-        for aae_ext in test_exts:
-            aaepath = basename + aae_ext
-            if os.path.exists(aaepath):
-                # make sure we aren't supposed to import this...
-                if do_not_move_set is not None and aaepath in do_not_move_set:
-                    if _verbose > 1:
-                        click.secho(f"... keeping {aaepath} for import", fg="green")
-                    return None
-                newpath = f"{aaepath}.bak"
-                if _verbose:
-                    click.secho(
-                        f"... moving {aaepath} to {newpath} for import", fg="green"
-                    )
-                os.rename(aaepath, newpath)
+    """Check if an AAE file exists for this file path, if so, return the pair of original AAE
+    file path and the AAE.bak file path it should be moved to. If the AAE file does not exist
+    or is in do_not_move_set, return None"""
 
-                return (aaepath, newpath)
-    return None
+    # look up the file and its AAE file in a cached listing of the directory instead of
+    # stat'ing each candidate; the AAE file is matched case-insensitively so this finds .AAE and .aae
+    if not file_exists(filepath):
+        return None
+    directory, filename = os.path.split(filepath)
+    basename, ext = os.path.splitext(filename)
+    aae_name = get_directory_entries(directory).names_by_lower.get(
+        f"{basename}.aae".lower()
+    )
+    if aae_name is None:
+        return None
+    aaepath = os.path.join(directory, aae_name)
+    # make sure we aren't supposed to import this...
+    if do_not_move_set is not None and aaepath in do_not_move_set:
+        if _verbose > 1:
+            click.secho(f"... keeping {aaepath} for import", fg="green")
+        return None
+    return (aaepath, f"{aaepath}.bak")
+
+
+def move_aae_files(to_move):
+    """Move AAE files to their .bak paths; to_move is a list of (original, moved) path pairs"""
+    if _verbose:
+        for original_file, moved_file in to_move:
+            click.secho(
+                f"... moving {original_file} to {moved_file} for import", fg="green"
+            )
+    rename_files(to_move)
 
 
 def move_aae_files_back(moved_aae):
-    for original_file, moved_file in moved_aae:
-        if _verbose > 0:
+    """Move AAE files previously moved by move_aae_files back to their original paths"""
+    if _verbose > 0:
+        for original_file, moved_file in moved_aae:
             click.secho(f"... moving {moved_file} back to {original_file}", fg="green")
-        os.rename(moved_file, original_file)
+    rename_files(
+        [(moved_file, original_file) for original_file, moved_file in moved_aae]
+    )
+
+
+@lru_cache(maxsize=None)
+def get_directory_entries(directory: str) -> DirectoryEntries:
+    """Return DirectoryEntries with the names of files in directory;
+    both are empty if directory cannot be read.
+
+    The result is cached so each directory is only read once; use rename_files() to rename
+    files so the cached listing stays current.
+    """
+    entries = DirectoryEntries(set(), {})
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                entries.names.add(entry.name)
+                entries.names_by_lower.setdefault(entry.name.lower(), entry.name)
+    except OSError:
+        pass
+    return entries
+
+
+def file_exists(filepath: str) -> bool:
+    """Return True if filepath exists, using the cached directory listing from get_directory_entries
+    instead of a stat call per file; the name must match exactly as the volume may be case-sensitive
+    """
+    directory, filename = os.path.split(filepath)
+    return filename in get_directory_entries(directory).names
 
 
-def verify_and_fix_zfilesystemvolume_data(photos_db_path: str):
+@lru_cache(maxsize=None)
+def get_rename_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Return a thread pool shared by all calls to rename_files so the threads are only started once"""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=RENAME_MAX_WORKERS)
+
+
+def rename_files(renames: List[Tuple[str, str]]):
+    """Rename each (src, dest) pair in renames, updating the cached directory listings from get_directory_entries
+
+    Renames are independent of each other so they're run concurrently to hide per-file
+    latency on network or external volumes.
+    """
+    if len(renames) > 1:
+        list(get_rename_executor().map(lambda rename: os.rename(*rename), renames))
+    elif renames:
+        os.rename(*renames[0])
+    # update the cache from this thread only to avoid racing on get_directory_entries
+    for src, dest in renames:
+        _update_directory_entries(src, dest)
+
+
+def _update_directory_entries(src: str, dest: str):
+    """Update the cached directory listings from get_directory_entries after src was renamed to dest"""
+    src_dir, src_name = os.path.split(src)
+    src_entries = get_directory_entries(src_dir)
+    src_entries.names.discard(src_name)
+    if src_entries.names_by_lower.get(src_name.lower()) == src_name:
+        del src_entries.names_by_lower[src_name.lower()]
+    dest_dir, dest_name = os.path.split(dest)
+    dest_entries = get_directory_entries(dest_dir)
+    dest_entries.names.add(dest_name)
+    dest_entries.names_by_lower[dest_name.lower()] = dest_name
+
+
+def verify_and_fix_zfilesystemvolume_data(photos_db_path: PhotosDB):
     """Verify that references to volume name and UUID are updated after fixing bookmarks"""
-    conn, c = open_sqlite_db(photos_db_path)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()  # need to get cursor again to use row_factory
+    with photos_db_connection(photos_db_path) as (conn, c):
+        # set row_factory on the cursor, not the connection, as the connection may be shared
+        c.row_factory = sqlite3.Row
+        # make all the fixes in a single transaction
+        with conn:
+            _verify_and_fix_zfilesystemvolume_data(conn, c)
+
 
+def _verify_and_fix_zfilesystemvolume_data(conn: sqlite3.Connection, c: sqlite3.Cursor):
+    """Verify and fix volume data using cursor c for the ZINTERNALRESOURCE query; does not commit"""
     # look at all the foreign keys in ZINTERNALRESOURCE to verify the volume UUID is correct
+    # the volume name and UUID are joined in so the whole check is a single scan
     c.execute(
-        """ SELECT Z_PK, ZFILESYSTEMBOOKMARK, ZFILESYSTEMVOLUME
+        """ SELECT
+                ZINTERNALRESOURCE.Z_PK,
+                ZINTERNALRESOURCE.ZFILESYSTEMBOOKMARK,
+                ZINTERNALRESOURCE.ZFILESYSTEMVOLUME,
+                ZFILESYSTEMVOLUME.Z_PK AS VOLUME_PK,
+                ZFILESYSTEMVOLUME.ZNAME,
+                ZFILESYSTEMVOLUME.ZVOLUMEUUIDSTRING
             FROM ZINTERNALRESOURCE
-            WHERE ZFILESYSTEMVOLUME IS NOT NULL OR ZFILESYSTEMBOOKMARK IS NOT NULL
+            LEFT JOIN ZFILESYSTEMVOLUME ON ZFILESYSTEMVOLUME.Z_PK = ZINTERNALRESOURCE.ZFILESYSTEMVOLUME
+            WHERE ZINTERNALRESOURCE.ZFILESYSTEMVOLUME IS NOT NULL
         """
     )
+    # read the volume table once; set_volume_info_for_zinternalresource keeps it current
+    volume_data = read_zfilesystemvolume_data(conn)
+    volume_index = index_zfilesystemvolume_data(volume_data)
     for row in c.fetchall():
-        if row["ZFILESYSTEMVOLUME"] is not None:
-            volume_id = row["ZFILESYSTEMVOLUME"]
-            volume_data = read_zfilesystemvolume_data(photos_db_path)
-            if volume_id not in volume_data:
+        if row["VOLUME_PK"] is None:
+            click.secho(
+                f"ZFILESYSTEMVOLUME {row['ZFILESYSTEMVOLUME']} not found in ZFILESYSTEMVOLUME table",
+                fg="red",
+                err=True,
+            )
+            continue
+        actual_volume_uuid = get_volume_uuid("/Volumes/" + row["ZNAME"])
+        if row["ZVOLUMEUUIDSTRING"] != actual_volume_uuid:
+            if _verbose > 2:
                 click.secho(
-                    f"ZFILESYSTEMVOLUME {volume_id} not found in ZFILESYSTEMVOLUME table",
-                    fg="red",
-                    err=True,
-                )
-                continue
-            volume = volume_data[volume_id]
-            actual_volume_uuid = get_volume_uuid("/Volumes/" + volume["ZNAME"])
-            if volume["ZVOLUMEUUIDSTRING"] != actual_volume_uuid:
-                if _verbose > 2:
-                    click.secho(
-                        f"Updating File System Volume UUID for {volume['ZNAME']} from {volume['ZVOLUMEUUIDSTRING']} to {actual_volume_uuid}"
-                    )
-                set_volume_info_for_zinternalresource(
-                    photos_db_path,
-                    row["Z_PK"],
-                    volume["ZNAME"],
-                    actual_volume_uuid,
+                    f"Updating File System Volume UUID for {row['ZNAME']} from {row['ZVOLUMEUUIDSTRING']} to {actual_volume_uuid}"
                 )
+            set_volume_info_for_zinternalresource(
+                conn,
+                row["Z_PK"],
+                row["ZNAME"],
+                actual_volume_uuid,
+                volume_data,
+                volume_index,
+                commit=False,
+            )
 
 
 def set_volume_info_for_zinternalresource(
-    photos_db_path: str, internal_resource_pk: int, volume_name: str, volume_uuid: str
+    photos_db_path: PhotosDB,
+    internal_resource_pk: int,
+    volume_name: str,
+    volume_uuid: str,
+    volume_data: Optional[Dict[int, sqlite3.Row]] = None,
+    volume_index: Optional[Dict[Tuple[str, str], int]] = None,
+    commit: bool = True,
 ) -> int:
-    """Set the volume info in the Photos database for a record in ZINTERNALRESOURCE, creating a new ZFILESYSTEMVOLUME record if needed"""
-    volume_data = read_zfilesystemvolume_data(photos_db_path)
-    conn, c = open_sqlite_db(photos_db_path)
-    for volume in volume_data.values():
-        if (
-            volume_name == volume["ZNAME"]
-            and volume_uuid == volume["ZVOLUMEUUIDSTRING"]
-        ):
-            # found the volume, update the uuid
+    """Set the volume info in the Photos database for a record in ZINTERNALRESOURCE, creating a new ZFILESYSTEMVOLUME record if needed
+
+    If volume_data (as returned by read_zfilesystemvolume_data) and volume_index (as returned by
+    index_zfilesystemvolume_data) are passed, they are used instead of re-reading ZFILESYSTEMVOLUME
+    and are updated in place if a new volume record is created.
+
+    If commit is False, changes are not committed; photos_db_path should then be an open connection
+    and the caller is responsible for committing.
+    """
+    if volume_data is None:
+        volume_data = read_zfilesystemvolume_data(photos_db_path)
+    if volume_index is None:
+        volume_index = index_zfilesystemvolume_data(volume_data)
+    with photos_db_connection(photos_db_path) as (conn, c):
+        # all statements for a new volume are run in one transaction, committed on success
+        # and rolled back on error; if commit is False, the caller manages the transaction
+        with conn if commit else contextlib.nullcontext():
+            if (volume_name, volume_uuid) in volume_index:
+                # found the volume, update the uuid
+                volume_pk = volume_index[(volume_name, volume_uuid)]
+                c.execute(
+                    "UPDATE ZINTERNALRESOURCE SET ZFILESYSTEMVOLUME = :volume_pk WHERE Z_PK = :resource_pk",
+                    {"volume_pk": volume_pk, "resource_pk": internal_resource_pk},
+                )
+                return volume_pk
+            # didn't find the volume, create a new one
+            new_uuid = str(uuid.uuid4()).upper()
+            z_ent = get_entity_id_from_photos_database(
+                _photos_db_cache_key(photos_db_path), "FileSystemVolume"
+            )
+            z_opt = 1
             c.execute(
-                "UPDATE ZINTERNALRESOURCE SET ZFILESYSTEMVOLUME = ? WHERE Z_PK = ?",
-                (volume["Z_PK"], internal_resource_pk),
+                "INSERT INTO ZFILESYSTEMVOLUME (Z_ENT, Z_OPT, ZNAME, ZUUID, ZVOLUMEUUIDSTRING) "
+                "VALUES (:z_ent, :z_opt, :name, :uuid, :volume_uuid)",
+                {
+                    "z_ent": z_ent,
+                    "z_opt": z_opt,
+                    "name": volume_name,
+                    "uuid": new_uuid,
+                    "volume_uuid": volume_uuid,
+                },
+            )
+            rowid = c.lastrowid
+            c.execute(
+                "UPDATE ZINTERNALRESOURCE SET ZFILESYSTEMVOLUME = :volume_pk WHERE Z_PK = :resource_pk",
+                {"volume_pk": rowid, "resource_pk": internal_resource_pk},
             )
-            conn.commit()
-            return volume["Z_PK"]
-    # didn't find the volume, create a new one
-    new_uuid = str(uuid.uuid4()).upper()
-    z_ent = get_entity_id_from_photos_database(photos_db_path, "FileSystemVolume")
-    z_opt = 1
-    c.execute(
-        "INSERT INTO ZFILESYSTEMVOLUME (Z_ENT, Z_OPT, ZNAME, ZUUID, ZVOLUMEUUIDSTRING) VALUES (?, ?, ?, ?, ?)",
-        (z_ent, z_opt, volume_name, new_uuid, volume_uuid),
-    )
-    rowid = c.lastrowid
-    c.execute(
-        "UPDATE ZINTERNALRESOURCE SET ZFILESYSTEMVOLUME = ? WHERE Z_PK = ?",
-        (rowid, internal_resource_pk),
-    )
 
-    # Increment the Z_MAX column of Z_PRIMARYKEY since we added a row to ZFILESYSTEMVOLUME
-    c.execute(
-        "UPDATE Z_PRIMARYKEY SET Z_MAX = Z_MAX + 1 WHERE Z_NAME = ?",
-        ("FileSystemVolume",),
-    )
-    conn.commit()
+            # Increment the Z_MAX column of Z_PRIMARYKEY since we added a row to ZFILESYSTEMVOLUME
+            c.execute(
+                "UPDATE Z_PRIMARYKEY SET Z_MAX = Z_MAX + 1 WHERE Z_NAME = :entity",
+                {"entity": "FileSystemVolume"},
+            )
 
+    volume_data[rowid] = {
+        "Z_PK": rowid,
+        "ZNAME": volume_name,
+        "ZUUID": new_uuid,
+        "ZVOLUMEUUIDSTRING": volume_uuid,
+    }
+    volume_index[(volume_name, volume_uuid)] = rowid
     return rowid
 
 
+def index_zfilesystemvolume_data(
+    volume_data: Dict[int, sqlite3.Row]
+) -> Dict[Tuple[str, str], int]:
+    """Return dict of ZFILESYSTEMVOLUME primary keys by (ZNAME, ZVOLUMEUUIDSTRING)"""
+    volume_index = {}
+    for volume in volume_data.values():
+        # if there are duplicate volumes, use the first one
+        volume_index.setdefault(
+            (volume["ZNAME"], volume["ZVOLUMEUUIDSTRING"]), volume["Z_PK"]
+        )
+    return volume_index
+
+
 @lru_cache
-def get_entity_id_from_photos_database(photos_db_path: str, entity: str) -> int:
+def get_entity_id_from_photos_database(photos_db_path: PhotosDB, entity: str) -> int:
     """Get the associated Z_ENT entity ID from the Z_PRIMARYKEY table for entity"""
-    conn, c = open_sqlite_db(photos_db_path)
-    results = c.execute(
-        "SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = ?", (entity,)
-    ).fetchone()
+    with photos_db_connection(photos_db_path) as (conn, c):
+        results = c.execute(
+            "SELECT Z_ENT FROM Z_PRIMARYKEY WHERE Z_NAME = ?", (entity,)
+        ).fetchone()
     if results is None:
         raise ValueError(f"Could not find entity {entity} in Z_PRIMARYKEY table")
     return results[0]
 
 
-def read_zfilesystemvolume_data(photos_db_path: str) -> Dict[int, sqlite3.Row]:
+def read_zfilesystemvolume_data(photos_db_path: PhotosDB) -> Dict[int, sqlite3.Row]:
     """Return contents of ZFILESYSTEMVOLUME table as a dict of sqlite3.Row objects"""
-    conn, c = open_sqlite_db(photos_db_path)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()  # need to get cursor again to use row_factory
-    c.execute("SELECT Z_PK, ZNAME, ZUUID, ZVOLUMEUUIDSTRING FROM ZFILESYSTEMVOLUME")
-    return {row["Z_PK"]: row for row in c.fetchall()}
+    with photos_db_connection(photos_db_path) as (conn, c):
+        # set row_factory on the cursor, not the connection, as the connection may be shared
+        c.row_factory = sqlite3.Row
+        c.execute("SELECT Z_PK, ZNAME, ZUUID, ZVOLUMEUUIDSTRING FROM ZFILESYSTEMVOLUME")
+        return {row["Z_PK"]: row for row in c.fetchall()}
 
 
 def volume_uuid_from_path(path: str) -> str:
     """Return the volume UUID for the given path"""
     if not path.startswith("/Volumes/"):
         return get_volume_uuid("/")
-    path_parts = os.path.split(path)
-    if len(path_parts < 2):
+    # "/Volumes/name/rest/of/path" -> ["", "Volumes", "name", "rest/of/path"]
+    path_parts = path.split("/", 3)
+    if not path_parts[2]:
         raise ValueError(f"Path '{path}' is not a valid volume path")
-    volume = os.path.join(path_parts[0], path_parts[1])
-    return get_volume_uuid(volume)
+    return get_volume_uuid(f"/Volumes/{path_parts[2]}")
 
 
 def verify_temp_library_signature():
     """Verify that the opened library is actually the temporary working library"""
-    photoslib = PhotosLibrary()
+    photoslib = get_photos_library()
     return photoslib.album(TEMP_LIBRARY_SENTINEL_ALBUM) is not None
 
 
@@ -597,98 +997,127 @@ def main(
             abort=True,
         )
 
-    click.echo("Reading data for referenced files from target library")
-    referenced_files = read_file_locations_from_photos_database(photos_db_path)
-
-    # read the bookmarks that have already been imported (this is likely to be NONE)
-    # the first time it is run.
+    # keep one connection to each database open for the whole repair instead of reopening per query
     temp_db_path = pathlib.Path(temp_library_path) / "database/Photos.sqlite"
-    imported_bookmarks = get_previously_imported_filepaths(temp_db_path)
-    if not restart and len(imported_bookmarks):
-        click.secho(
-            f"There are previously imported bookmarks in the temporary photos library "
-            "but you did not use --restart.\n"
-            "If you intend to restart an import, use --restart or delete the temporary photos library at:\n"
-            f"{temp_library_path}",
-            fg="red",
-        )
-        raise click.Abort("Temporary library is not empty but --restart not specified")
-    else:
-        click.echo(
-            f"Found '{len(imported_bookmarks)}' already imported from previous run"
-        )
+    photos_db_conn, _ = open_sqlite_db(photos_db_path)
+    # the temporary library is only ever read, Photos does the writing when files are imported
+    temp_db_conn, _ = open_sqlite_db(temp_db_path, read_only=True)
+    try:
+        click.echo("Reading data for referenced files from target library")
+        prime_volume_uuid_cache(photos_db_conn)
+        referenced_files = read_file_locations_from_photos_database(photos_db_conn)
+
+        # read the bookmarks that have already been imported (this is likely to be NONE)
+        # the first time it is run.
+        # paths are interned so membership tests against both sets can match on identity
+        imported_bookmarks = {
+            sys.intern(filepath)
+            for filepath in get_previously_imported_filepaths(temp_db_conn)
+        }
+        if not restart and len(imported_bookmarks):
+            click.secho(
+                f"There are previously imported bookmarks in the temporary photos library "
+                "but you did not use --restart.\n"
+                "If you intend to restart an import, use --restart or delete the temporary photos library at:\n"
+                f"{temp_library_path}",
+                fg="red",
+            )
+            raise click.Abort(
+                "Temporary library is not empty but --restart not specified"
+            )
+        else:
+            click.echo(
+                f"Found '{len(imported_bookmarks)}' already imported from previous run"
+            )
 
-    to_import_set = set(referenced_files.values())
-    import_groups = list(
-        make_import_groups(referenced_files.values(), imported_bookmarks)
-    )
+        to_import_set = {sys.intern(filepath) for filepath in referenced_files.values()}
+        # the set is only for membership tests; group from a sorted list so the import order is the same every run
+        import_groups = list(
+            make_import_groups(sorted(to_import_set), imported_bookmarks)
+        )
 
-    ntried = 0
-    click.echo("Importing photos into temporary working library")
-    for filepath_groups in chunk_iterable(groupsize, import_groups):
-        filepaths = [fp for fplist in filepath_groups for fp in fplist]
+        ntried = 0
+        click.echo("Importing photos into temporary working library")
+        for filepath_groups in chunked(import_groups, groupsize):
+            filepaths = list(itertools.chain.from_iterable(filepath_groups))
 
-        to_import = []
-        moved_aae = []
-        for filepath in filepaths:
-            click.echo(f"Processing file {filepath}")
-            if not os.path.exists(filepath):
-                click.secho(
-                    f"Skipping missing file '{filepath}', cannot rewrite bookmarks for missing files.",
-                    err=True,
-                    fg="red",
-                )
-                continue
-            if filepath in imported_bookmarks:
-                if _verbose > 1:
+            to_import = []
+            moved_aae = []
+            for filepath in filepaths:
+                click.echo(f"Processing file {filepath}")
+                if not file_exists(filepath):
                     click.secho(
-                        f"... used previously imported '{filepath}'", fg="green"
+                        f"Skipping missing file '{filepath}', cannot rewrite bookmarks for missing files.",
+                        err=True,
+                        fg="red",
                     )
-            else:
-                to_import.append(filepath)
-
-            if move_aae:
-                aaefile = move_aae_file_if_it_exists(
-                    filepath, do_not_move_set=to_import_set
-                )
-                if aaefile is not None:
-                    moved_aae.append(aaefile)
-
-        if to_import:
-            import_files_to_photos(to_import)
-            time.sleep(SLEEP_TIME_AFTER_IMPORT)
-            ntried += 1
-            if moved_aae:
-                move_aae_files_back(moved_aae)
-            if ntried % imports_before_pausing == 0:
-                click.echo(
-                    f"Pausing after {imports_before_pausing} imports (total imports = {ntried})"
-                )
-                # pl = PhotosLibrary()
-                # pl.quit()
-                time.sleep(SLEEP_TIME_AFTER_QUIT)
-                # pl.activate()
-                # time.sleep(SLEEP_TIME_AFTER_ACTIVATE)
-            if ntried >= max_imports:
-                click.echo(f"Stopping after {max_imports} imports")
-                sys.exit(1)
+                    continue
+                if filepath in imported_bookmarks:
+                    if _verbose > 1:
+                        click.secho(
+                            f"... used previously imported '{filepath}'", fg="green"
+                        )
+                else:
+                    to_import.append(filepath)
+
+                if move_aae:
+                    aaefile = find_aae_file_to_move(
+                        filepath, do_not_move_set=to_import_set
+                    )
+                    # files in the same group may share an AAE file
+                    if aaefile is not None and aaefile not in moved_aae:
+                        moved_aae.append(aaefile)
+
+            if to_import:
+                if moved_aae:
+                    move_aae_files(moved_aae)
+                try:
+                    bookmark_count = count_zfilesystembookmark_records(temp_db_conn)
+                    import_files_to_photos(to_import)
+                    wait_for_photos_import(
+                        temp_db_conn,
+                        bookmark_count + len(to_import),
+                        SLEEP_TIME_AFTER_IMPORT,
+                    )
+                finally:
+                    # put the AAE files back even if the import failed
+                    if moved_aae:
+                        move_aae_files_back(moved_aae)
+                ntried += 1
+                if ntried % imports_before_pausing == 0:
+                    click.echo(
+                        f"Pausing after {imports_before_pausing} imports (total imports = {ntried})"
+                    )
+                    # pl = get_photos_library()
+                    # pl.quit()
+                    time.sleep(SLEEP_TIME_AFTER_QUIT)
+                    # pl.activate()
+                    # time.sleep(SLEEP_TIME_AFTER_ACTIVATE)
+                if ntried >= max_imports:
+                    click.echo(f"Stopping after {max_imports} imports")
+                    sys.exit(1)
 
-    click.confirm(
-        "Please quit Photos.\n" "Type 'y' when you have done this.",
-        abort=True,
-    )
-    while photos_is_running():
-        click.secho("Photos is still running, please quit it", fg="red", err=True)
         click.confirm(
             "Please quit Photos.\n" "Type 'y' when you have done this.",
             abort=True,
         )
+        while photos_is_running():
+            click.secho("Photos is still running, please quit it", fg="red", err=True)
+            click.confirm(
+                "Please quit Photos.\n" "Type 'y' when you have done this.",
+                abort=True,
+            )
 
-    click.echo("Rewriting bookmarks in target library")
-    update_bookmarks_in_photos_database(referenced_files, photos_db_path, temp_db_path)
+        click.echo("Rewriting bookmarks in target library")
+        update_bookmarks_in_photos_database(
+            referenced_files, photos_db_conn, temp_db_conn, to_import_set
+        )
 
-    click.echo("Updating file system volume data in target library")
-    verify_and_fix_zfilesystemvolume_data(photos_db_path)
+        click.echo("Updating file system volume data in target library")
+        verify_and_fix_zfilesystemvolume_data(photos_db_conn)
+    finally:
+        photos_db_conn.close()
+        temp_db_conn.close()
 
     click.confirm(
         f"Please open Photos while holding down the Option key then select your target library: {photos_library_path}\n"
@@ -1,31 +1,64 @@
 """Repair 'Missing File' errors in Photos caused by moving referenced files to a different drive"""
 
+import ctypes
+import ctypes.util
+import hashlib
 import os
 import pathlib
 import sqlite3
-import urllib
 import time
 import sys
 import itertools
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 
 import click
-import CoreFoundation
-import objc
-import psutil
-from Foundation import kCFAllocatorDefault
 from mac_alias import Bookmark, kBookmarkPath
-from photoscript import PhotosLibrary
-from photoscript.utils import ditto
+
+# the macOS frameworks and photoscript are imported in the functions that use them; they're slow
+# to load and not needed for --help or in the worker processes that resolve bookmarks
 
 _verbose = 0
 
-# we just use one instance of the script
-global_photoslib = PhotosLibrary()
+# we just use one instance of the script, created on first use so that
+# worker processes that import this module don't each connect to Photos
+_global_photoslib = None
+
+def get_photoslib():
+    """ Return the shared PhotosLibrary instance """
+    global _global_photoslib
+    if _global_photoslib is None:
+        from photoscript import PhotosLibrary
+
+        _global_photoslib = PhotosLibrary()
+    return _global_photoslib
+
+def reset_photoslib():
+    """ Drop the shared PhotosLibrary instance so the next get_photoslib() connects afresh,
+    use after the user has quit and reopened Photos """
+    global _global_photoslib
+    _global_photoslib = None
 
 TEMPLATE_DIRECTORY = "template_libraries"
 TEMPLATE_LIBRARY = "osxphotos_temporary_working_library.photoslibrary"
 TEMP_LIBRARY_SENTINEL_ALBUM = "ZZZ_OSXPHOTOS_SENTINEL_ZZZ"
 
+# bookmarks are resolved in worker processes when there are at least this many,
+# for fewer, starting the workers costs more than it saves
+RESOLVE_BOOKMARKS_PARALLEL_THRESHOLD = 2000
+
+# at most this many resolved bookmark paths are cached, each entry is just a digest and a path
+RESOLVE_BOOKMARKS_CACHE_SIZE = 65536
+_resolved_bookmark_paths = OrderedDict()
+
+# files from several groups are sent to Photos in one import of at least this many files
+IMPORT_BATCH_SIZE = 200
+
+# max seconds to wait for Photos to add an import to the temporary library
+# the wait ends as soon as the imported files show up in the database
+IMPORT_WAIT_TIMEOUT = 0.25
+
 
 def get_temp_photos_library_dir():
     # is picture folder always here independent of locale or language?
@@ -36,31 +69,64 @@ def get_temp_photos_library_dir():
     dest = picture_folder / TEMPLATE_LIBRARY
     return dest
 
+def _clonefile(src, dest):
+    """ Clone src to dest with the APFS clonefile() call, this also clones a directory tree.
+    Returns True if the clone was made, False if it couldn't be (not APFS, dest exists, etc). """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        clonefile = libc.clonefile
+    except (OSError, AttributeError):
+        return False
+    clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32]
+    clonefile.restype = ctypes.c_int
+    return clonefile(os.fsencode(str(src)), os.fsencode(str(dest)), 0) == 0
+
 def copy_temporary_photos_library():
     """copy the template library and open Photos, returns path to copied library"""
     src = pathlib.Path(TEMPLATE_DIRECTORY) / TEMPLATE_LIBRARY
 
     dest = get_temp_photos_library_dir()
-    ditto(src, dest)
+    # a copy on write clone is near instant and takes no extra space, fall back to
+    # copying everything with ditto when src and dest aren't on the same APFS volume
+    if not _clonefile(src, dest):
+        from photoscript.utils import ditto
+
+        ditto(src, dest)
     return str(dest)
 
 
 def verify_temp_library_signature():
     """Verify that the loaded library is actually the temporary working library"""
     #return PhotosLibrary().album(TEMP_LIBRARY_SENTINEL_ALBUM) is not None
-    return global_photoslib.album(TEMP_LIBRARY_SENTINEL_ALBUM) is not None
+    return get_photoslib().album(TEMP_LIBRARY_SENTINEL_ALBUM) is not None
 
 
 def photos_is_running():
     """Check if Photos is running"""
-    return any(p.name() == "Photos" for p in psutil.process_iter())
+    from AppKit import NSRunningApplication
 
+    # ask AppKit for Photos by bundle id instead of walking the whole process table
+    return bool(NSRunningApplication.runningApplicationsWithBundleIdentifier_("com.apple.Photos"))
 
-def open_sqlite_db(fname: str):
-    """Open sqlite database and return connection to the database"""
+
+def open_sqlite_db(fname: str, readonly=False):
+    """Open sqlite database and return connection to the database
+    If readonly is True, the database is opened with mode=ro and can't be written to."""
     try:
-        conn = sqlite3.connect(f"{fname}")
+        if readonly:
+            # not immutable=1, Photos may have the database open and be writing to it
+            conn = sqlite3.connect(f"{pathlib.Path(fname).absolute().as_uri()}?mode=ro", uri=True)
+        else:
+            conn = sqlite3.connect(f"{fname}")
         c = conn.cursor()
+        if not readonly:
+            # WAL with NORMAL sync avoids an fsync per commit
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+        # bigger page cache, in-memory temp tables and memory mapped reads
+        c.execute("PRAGMA cache_size=-65536")
+        c.execute("PRAGMA mmap_size=268435456")
+        c.execute("PRAGMA temp_store=MEMORY")
     except sqlite3.Error as e:
         raise OSError(f"Error opening {fname}: {e}")
     return (conn, c)
@@ -70,20 +136,32 @@ def resolve_bookmark_path(bookmark_data: bytes) -> str:
     """Get the path from a CFURL file bookmark
     This works without calling CFURLCreateByResolvingBookmarkData
     which fails if the target file does not exist
+    Results are cached because the same bookmark data is resolved by more than one step,
+    the cache is keyed by a digest of bookmark_data so it doesn't hold on to the bookmarks.
     """
+    key = hashlib.blake2b(bookmark_data, digest_size=16).digest()
+    if key in _resolved_bookmark_paths:
+        _resolved_bookmark_paths.move_to_end(key)
+        return _resolved_bookmark_paths[key]
     try:
         bookmark = Bookmark.from_bytes(bookmark_data)
     except Exception as e:
         raise ValueError(f"Invalid bookmark: {e}")
     path_components = bookmark.get(kBookmarkPath, None)
-    if not path_components:
-        return None
-    return "/" + os.path.join(*path_components)
+    path = "/" + "/".join(path_components) if path_components else None
+    _resolved_bookmark_paths[key] = path
+    if len(_resolved_bookmark_paths) > RESOLVE_BOOKMARKS_CACHE_SIZE:
+        # drop the least recently used path
+        _resolved_bookmark_paths.popitem(last=False)
+    return path
 
 
 # TODO Remove this in the future as it's slower and not used!
 def _resolve_cfdata_bookmark(bookmark: bytes) -> str:
     """Resolve a bookmark stored as a serialized CFData object into a path str"""
+    import CoreFoundation
+    import objc
+    from Foundation import kCFAllocatorDefault
 
     with objc.autorelease_pool():
         # use CFURLCreateByResolvingBookmarkData to de-serialize bookmark data into a CFURLRef
@@ -94,9 +172,8 @@ def _resolve_cfdata_bookmark(bookmark: bytes) -> str:
         # the CFURLRef we got is a sruct that python treats as an array
         # I'd like to pass this to CFURLGetFileSystemRepresentation to get the path but
         # CFURLGetFileSystemRepresentation barfs when it gets an array from python instead of expected struct
-        # first element is the path string in form:
-        # file:///Users/username/Pictures/Photos%20Library.photoslibrary/
-        urlstr = url[0].absoluteString() if url[0] else None
+        # first element is the URL, which is toll-free bridged to NSURL
+        fileurl = url[0]
 
         # get detailed info about the bookmark for reverse engineering
         # resources = CoreFoundation.CFURLCreateResourcePropertiesForKeysFromBookmarkData(
@@ -106,14 +183,12 @@ def _resolve_cfdata_bookmark(bookmark: bytes) -> str:
         # )
         # print(f"{resources['NSURLBookmarkDetailedDescription']}")
 
-        # now coerce the file URI back into an OS path
-        # surely there must be a better way
-        if not urlstr:
+        if not fileurl:
             raise ValueError("Could not resolve bookmark")
 
-        return os.path.normpath(
-            urllib.parse.unquote(urllib.parse.urlparse(urlstr).path)
-        )
+        # NSURL.path() gives the decoded file system path without the trailing slash,
+        # no need to parse and unquote the URL string
+        return os.path.normpath(str(fileurl.path()))
 
 
 def read_file_locations_from_photos_database(photos_db_path):
@@ -123,14 +198,21 @@ def read_file_locations_from_photos_database(photos_db_path):
     # read all the bookmarks
     # TODO: Do we really need to resolve the bookmarks or can we construct the path from the ZFILESYSTEMBOOKMARK.ZPATHRELATIVETOVOLUME and ZFILESYSTEMVOLUME.ZNAME fields?
     # Note, it's best / simplest to resolve the bookmarks, although the other info could be a backup
+    bookmarks = [bookmark_data for _, _, bookmark_data in results]
+    if len(bookmarks) >= RESOLVE_BOOKMARKS_PARALLEL_THRESHOLD:
+        # parsing bookmarks is CPU bound and independent for each one so spread it across cores
+        with ProcessPoolExecutor() as executor:
+            resolved = list(executor.map(_try_resolve_bookmark_path, bookmarks, chunksize=256))
+    else:
+        resolved = map(_try_resolve_bookmark_path, bookmarks)
+
     referenced_files = {}
-    for pk, pathstr, bookmark_data in results:
-        try:
-            bookmark_path = resolve_bookmark_path(bookmark_data)
+    for (pk, pathstr, _), (bookmark_path, error) in zip(results, resolved):
+        if error is None:
             referenced_files[pk] = bookmark_path
             if _verbose > 2:
                 click.secho(f"... will import path '{bookmark_path}'", fg="green")
-        except ValueError as e:
+        else:
             # if the file is missing, we can't resolve the bookmark
             click.secho(
                 f"Skipping missing file '{pathstr}', cannot resolve bookmarks for missing files.",
@@ -140,6 +222,14 @@ def read_file_locations_from_photos_database(photos_db_path):
     return referenced_files
 
 
+def _try_resolve_bookmark_path(bookmark_data):
+    """ Return (path, None) for bookmark_data or (None, error) if it can't be resolved """
+    try:
+        return (resolve_bookmark_path(bookmark_data), None)
+    except ValueError as e:
+        return (None, str(e))
+
+
 def import_file_to_photos(filepath):
     """import a file into Photos"""
     import_files_to_photos([filepath])
@@ -147,7 +237,7 @@ def import_file_to_photos(filepath):
 def import_files_to_photos(filepaths):
     """import a file into Photos"""
     #pl = PhotosLibrary()
-    pl = global_photoslib
+    pl = get_photoslib()
     if _verbose > 2:
         click.secho(f"... doing import of ", fg="green")
         for filepath in filepaths:
@@ -160,76 +250,124 @@ def _read_zfilesystem_bookmark_from_photos_database(photos_db_path, *,
     filter_null_bookmark_data is True by default, which skips records where zbookmarkdata is null.
     This returns a list of tuples, with primarykey, pathrel, and bookmarkdata.
     """
-    (conn, c) = open_sqlite_db(photos_db_path)
-    c.execute(
-        "SELECT Z_PK, ZPATHRELATIVETOVOLUME, ZBOOKMARKDATA FROM ZFILESYSTEMBOOKMARK"
-    )
-    results = []
-    for row in c:
-        pk = row[0]
-        pathstr = row[1]
-        bookmark_data = row[2]
-        if bookmark_data or filter_null_bookmark_data is False:
-            results.append((pk, pathstr, bookmark_data))
+    sql = "SELECT Z_PK, ZPATHRELATIVETOVOLUME, ZBOOKMARKDATA FROM ZFILESYSTEMBOOKMARK"
+    if filter_null_bookmark_data:
+        # let sqlite drop the null (and empty) bookmarks instead of checking each row in python
+        sql += " WHERE length(ZBOOKMARKDATA) > 0"
+    (conn, c) = open_sqlite_db(photos_db_path, readonly=True)
+    rows = c.execute(sql).fetchall()
     conn.close()
-    return results
-
-def _get_bookmark_data_by_path(db_path):
-    results = _read_zfilesystem_bookmark_from_photos_database(db_path)
-    bookmarks_by_path = {}
-    for pk, pathstr, bookmarkdata in results:
-        # resolve the bookmark data
-        filepath = resolve_bookmark_path(bookmarkdata)
-        bookmarks_by_path[filepath] = bookmarkdata
-    return bookmarks_by_path
-
-def update_bookmarks_in_photos_database(referenced_files, photos_db_path, import_db_path):
-    """Update bookmarks for referenced files in a Photos library database"""
-    new_bookmarks = _get_bookmark_data_by_path(import_db_path)
-    # update each bookmark in the database
+    return rows
+
+def _count_zfilesystem_bookmarks(photos_db_path):
+    """ Return the number of rows in the ZFILESYSTEMBOOKMARK table """
+    (conn, c) = open_sqlite_db(photos_db_path, readonly=True)
+    count = c.execute("SELECT COUNT(*) FROM ZFILESYSTEMBOOKMARK").fetchone()[0]
+    conn.close()
+    return count
+
+def wait_for_import(photos_db_path, expected_count, timeout=IMPORT_WAIT_TIMEOUT):
+    """ Wait until the ZFILESYSTEMBOOKMARK table has expected_count rows or timeout seconds
+    have passed, polling with an exponential back off capped at 50ms """
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while _count_zfilesystem_bookmarks(photos_db_path) < expected_count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+
+def _match_bookmarks_by_volume_path(c):
+    """ Return dict of import library Z_PK by Photos library Z_PK for the bookmarks that have the same
+    volume name and path relative to the volume in both libraries. The import library must be attached as importdb. """
+    # the absolute path to the photos must be the same in both libraries so (ZNAME, ZPATHRELATIVETOVOLUME)
+    # identifies the file without resolving any bookmarks
+    sql = """
+        SELECT b.Z_PK, ib.Z_PK
+        FROM main.ZFILESYSTEMBOOKMARK b
+        JOIN main.ZINTERNALRESOURCE r ON r.ZFILESYSTEMBOOKMARK = b.Z_PK
+        JOIN main.ZFILESYSTEMVOLUME v ON v.Z_PK = r.ZFILESYSTEMVOLUME
+        JOIN importdb.ZFILESYSTEMVOLUME iv ON iv.ZNAME = v.ZNAME
+        JOIN importdb.ZINTERNALRESOURCE ir ON ir.ZFILESYSTEMVOLUME = iv.Z_PK
+        JOIN importdb.ZFILESYSTEMBOOKMARK ib
+            ON ib.Z_PK = ir.ZFILESYSTEMBOOKMARK AND ib.ZPATHRELATIVETOVOLUME = b.ZPATHRELATIVETOVOLUME
+        WHERE length(ib.ZBOOKMARKDATA) > 0
+    """
+    matches = {}
+    for pk, import_pk in c.execute(sql):
+        # a resource may be listed more than once, keep the first match
+        matches.setdefault(pk, import_pk)
+    return matches
+
+def update_bookmarks_in_photos_database(referenced_files, photos_db_path, import_db_path, referenced_paths=None):
+    """Update bookmarks for referenced files in a Photos library database
+    referenced_paths is the set of paths in referenced_files, it's built here if not passed."""
     (conn, c) = open_sqlite_db(photos_db_path)
+    c.execute("ATTACH DATABASE ? AS importdb", (str(import_db_path),))
+    matched = _match_bookmarks_by_volume_path(c)
+
+    # rows without a volume match (e.g. no ZINTERNALRESOURCE record) fall back to resolving the bookmarks
+    # that weren't matched in the import library
+    unmatched = {pk: filepath for pk, filepath in referenced_files.items() if pk not in matched}
+    new_bookmarks = {}
+    if unmatched:
+        matched_import_pks = set(matched.values())
+        for import_pk, _, bookmarkdata in _read_zfilesystem_bookmark_from_photos_database(import_db_path):
+            if import_pk not in matched_import_pks:
+                new_bookmarks[resolve_bookmark_path(bookmarkdata)] = bookmarkdata
+
     updated_paths = set()
+    rows = []
+    data_rows = []
     for pk, filepath in referenced_files.items():
         if _verbose > 0:
             click.secho(f"Updating bookmark for {filepath} with primary key = {pk}", fg="green")
-        if filepath not in new_bookmarks:
+        if pk in matched:
+            rows.append((matched[pk], pk))
+            updated_paths.add(filepath)
+        elif filepath not in new_bookmarks:
             click.secho(
                 f"File '{filepath}' is not in ZFILESYSTEMBOOKMARK", fg="red", err=True
             )
         else:
-            bookmark_data = new_bookmarks[filepath]
-            conn.execute(
-                "UPDATE ZFILESYSTEMBOOKMARK SET ZBOOKMARKDATA = ? WHERE Z_PK = ?",
-                (bytes(bookmark_data), pk),
-            )
+            data_rows.append((new_bookmarks[filepath], pk))
             updated_paths.add(filepath)
+
+    # update all the bookmarks in the database in one transaction,
+    # matched bookmarks are copied by sqlite and never pass through python
+    conn.execute("BEGIN IMMEDIATE")
+    with conn:
+        c.executemany(
+            "UPDATE main.ZFILESYSTEMBOOKMARK SET ZBOOKMARKDATA = "
+            "(SELECT ZBOOKMARKDATA FROM importdb.ZFILESYSTEMBOOKMARK WHERE Z_PK = ?) WHERE Z_PK = ?",
+            rows,
+        )
+        c.executemany(
+            "UPDATE main.ZFILESYSTEMBOOKMARK SET ZBOOKMARKDATA = ? WHERE Z_PK = ?", data_rows
+        )
+    conn.close()
     if _verbose > 0:
-        missing = set(referenced_files.values()).difference(updated_paths)
+        if referenced_paths is None:
+            referenced_paths = set(referenced_files.values())
+        missing = referenced_paths.difference(updated_paths)
         for pathstr in missing:
             click.secho(f"File '{pathstr}' was not updated", fg="yellow", err=True)
         if len(missing) == 0:
             click.secho("All files were updated")
-    conn.commit()
-    conn.close()
 
 def get_previously_imported_filepaths(photos_db_path):
     results = _read_zfilesystem_bookmark_from_photos_database(photos_db_path)
-    allpaths = set()
-    for pk, pathstr, bookmark_data in results:
-        fullpath = resolve_bookmark_path(bookmark_data)
-        allpaths.add(fullpath)
-    return allpaths
-
-# from https://stackoverflow.com/questions/8991506/iterate-an-iterator-by-chunks-of-n-in-python
-def grouper_it(n, iterable):
-    it = iter(iterable)
-    while True:
-        chunk_it = itertools.islice(it, n)
-        try:
-            first_el = next(chunk_it)
-        except StopIteration:
-            return
-        yield itertools.chain((first_el,), chunk_it)
+    return {resolve_bookmark_path(bookmark_data) for _, _, bookmark_data in results}
+
+try:
+    # python 3.12+, batches are built in C
+    from itertools import batched
+except ImportError:
+    def batched(iterable, n):
+        """ Yield successive lists of n items from iterable, the last may be shorter """
+        it = iter(iterable)
+        return iter(lambda: list(itertools.islice(it, n)), [])
 
 def filename_parts_from_filepath(filepath):
     """Apple Photos has many files that are really a group, e.g.
@@ -244,73 +382,173 @@ def filename_parts_from_filepath(filepath):
 
 def group_filepaths(filepaths):
     """This takes a list of filepaths and returns all the groups."""
-    keyfunc = filename_parts_from_filepath
-    groups = []
-    gsorted = sorted(filepaths, key=keyfunc)
-    for k, g in itertools.groupby(gsorted, keyfunc):
-        groups.append(list(g))      # Store  group iterator as a list
-    return groups
-
-def _already_all_imported(group, imported_filepaths):
-    """ Test is all the filepaths in groups are already imported in
-    imported_filepaths"""
-    nimported = 0
-    for fp in group:
-        if fp in imported_filepaths:
-            nimported += 1
-    if nimported == len(group):
-        return True
-    else:
-        return False
+    # one pass into buckets by key instead of sorting then grouping
+    groups = defaultdict(list)
+    for filepath in filepaths:
+        groups[filename_parts_from_filepath(filepath)].append(filepath)
+    return list(groups.values())
 
 def make_import_groups(filepaths, imported_filepaths):
     """ Group files and find all the groups where at least one file isn't imported. """
     groups = group_filepaths(filepaths)
-    check_group = lambda group: not _already_all_imported(group, imported_filepaths)
-    not_imported = filter(check_group, groups)
-    return not_imported
-
-def move_aae_file_if_it_exists(filepath, dont_move_set=None):
+    # work out once which files still need importing, then a group needs importing
+    # if it shares any file with that set
+    needs_import = {fp for fp in filepaths if fp not in imported_filepaths}
+    return (group for group in groups if not needs_import.isdisjoint(group))
+
+@lru_cache(maxsize=None)
+def _dir_entries(directory):
+    """ Return (names, names_by_lower) for directory, read once with os.scandir.
+    names is the set of exact file names, names_by_lower maps lower case names to file names
+    so the .AAE or .aae sidecar can be found whatever its case.
+    Use _rename so the cached entries are kept up to date. """
+    names = set()
+    names_by_lower = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                names.add(entry.name)
+                names_by_lower.setdefault(entry.name.lower(), entry.name)
+    except OSError:
+        pass
+    return (names, names_by_lower)
+
+def _file_exists(filepath):
+    """ Check if filepath exists using the cached directory entries instead of a stat call """
+    directory, filename = os.path.split(filepath)
+    return filename in _dir_entries(directory)[0]
+
+def _rename(src, dest):
+    """ Rename src to dest and update the cached directory entries """
+    os.rename(src, dest)
+    src_dir, src_name = os.path.split(src)
+    names, names_by_lower = _dir_entries(src_dir)
+    names.discard(src_name)
+    if names_by_lower.get(src_name.lower()) == src_name:
+        del names_by_lower[src_name.lower()]
+    dest_dir, dest_name = os.path.split(dest)
+    names, names_by_lower = _dir_entries(dest_dir)
+    names.add(dest_name)
+    names_by_lower.setdefault(dest_name.lower(), dest_name)
+
+def move_aae_file_if_it_exists(filepath, dont_move_set=None, echo=click.secho):
     """ Check if an AAE file exists for this file path, if so, we move it to an AAE.bak file,
     And return the pair of original AAE file path and moved file path. If the AAE file does not
-    Exist, we return None. """
-
-    # check upper and lowercase aae extensions
-    # make sure file path exists
-    test_exts = [".AAE", ".aae"]
-    if os.path.exists(filepath):
-        basename, ext = os.path.splitext(filepath)
-        for aae_ext in test_exts:
-            aaepath = basename + aae_ext
-            if os.path.exists(aaepath):
-                # make sure we aren't supposed to import this...
-                if dont_move_set is not None and aaepath in dont_move_set:
-                    if _verbose > 1:
-                        click.secho(f"... keeping {aaepath} for import", fg="green")
-                    return None
-                newpath = aaepath + ".bak"
-                if _verbose:
-                    click.secho(f"... moving {aaepath} to {newpath} for import", fg="green")
-                os.rename(aaepath, newpath)
-
-                return (aaepath, newpath)
+    Exist, we return None. Messages are reported with echo. """
+
+    # check for the file and an .AAE or .aae file in one cached listing of the directory
+    directory, filename = os.path.split(filepath)
+    if _file_exists(filepath):
+        basename, ext = os.path.splitext(filename)
+        aae_name = _dir_entries(directory)[1].get(basename.lower() + ".aae")
+        if aae_name is not None:
+            aaepath = os.path.join(directory, aae_name)
+            # make sure we aren't supposed to import this...
+            if dont_move_set is not None and aaepath in dont_move_set:
+                if _verbose > 1:
+                    echo(f"... keeping {aaepath} for import", fg="green")
+                return None
+            newpath = aaepath + ".bak"
+            if _verbose:
+                echo(f"... moving {aaepath} to {newpath} for import", fg="green")
+            _rename(aaepath, newpath)
+
+            return (aaepath, newpath)
     return None
 
-def move_aae_files_back(moved_aae):
+def move_aae_files_back(moved_aae, echo=click.secho):
     for (original_file, moved_file) in moved_aae:
         if _verbose > 0:
-            click.secho(f"... moving {moved_file} back to {original_file}", fg="green")
-        os.rename(moved_file, original_file)
+            echo(f"... moving {moved_file} back to {original_file}", fg="green")
+        _rename(moved_file, original_file)
+
+
+def prepare_import_batches(import_groups, groupsize, imported_bookmarks, to_import_set, move_aae,
+                           imports_before_pausing, max_imports):
+    """ Yield (to_import, moved_aae, ntried, messages) batches of files that are ready to import into Photos.
+    Groups are taken groupsize at a time and ntried counts each of these that has files to import,
+    the same as when each one was a separate import, so imports_before_pausing and max_imports keep
+    their meaning. A batch ends when it has IMPORT_BATCH_SIZE files to import or ntried reaches a
+    multiple of imports_before_pausing, and nothing more is prepared once ntried reaches max_imports.
+    The AAE files for a batch have already been moved out of the way when it is yielded.
+    This runs in a worker thread so nothing is printed, messages is a list of (message, styles)
+    for the caller to pass to click.secho. """
+    to_import = []
+    moved_aae = []
+    messages = []
+    ntried = 0
+
+    def echo(message, **styles):
+        messages.append((message, styles))
+
+    try:
+        for filepath_groups in batched(import_groups, groupsize):
+            filepaths = list(itertools.chain.from_iterable(filepath_groups))
+            nqueued = len(to_import)
+
+            for filepath in filepaths:
+                echo(f"Processing file {filepath}")
+                if not _file_exists(filepath):
+                    echo(
+                        f"Skipping missing file '{filepath}', cannot rewrite bookmarks for missing files.",
+                        err=True,
+                        fg="red",
+                    )
+                    continue
+                if filepath in imported_bookmarks:
+                    if _verbose > 1:
+                        echo(f"... used previously imported '{filepath}'", fg="green")
+                else:
+                    to_import.append(filepath)
+
+                if move_aae:
+                    aaefile = move_aae_file_if_it_exists(filepath, dont_move_set=to_import_set, echo=echo)
+                    if aaefile is not None:
+                        moved_aae.append(aaefile)
+
+            if len(to_import) == nqueued:
+                # nothing to import from these groups so they don't count as an import
+                continue
+            ntried += 1
+            if (len(to_import) >= IMPORT_BATCH_SIZE or ntried % imports_before_pausing == 0
+                    or ntried >= max_imports):
+                # hand the batch over before yielding, from here on the caller puts its AAE files back
+                batch = (to_import, moved_aae, ntried, messages)
+                to_import, moved_aae, messages = [], [], []
+                yield batch
+            if ntried >= max_imports:
+                return
+    except BaseException:
+        # don't leave the AAE files for a half prepared batch moved out of the way
+        move_aae_files_back(moved_aae, echo=echo)
+        raise
+
+    # whatever is left over from the last batch
+    if len(to_import) > 0 or len(moved_aae) > 0:
+        yield (to_import, moved_aae, ntried, messages)
 
 
 @click.command()
 @click.argument("photos_library_path", type=click.Path(exists=True))
 @click.option("-v", "--verbose", count=True)
 @click.option("--restart", default=False)
-@click.option("--groupsize", default=5)
+@click.option(
+    "--groupsize",
+    default=5,
+    help="Number of file groups counted as one import by --imports-before-pausing and --max-imports. "
+    "Files from several imports are sent to Photos together. Default is 5.",
+)
 @click.option("--move-aae", default=True)
-@click.option("--max-imports", default=10000)
-@click.option("--imports-before-pausing", default=250)
+@click.option(
+    "--max-imports",
+    default=10000,
+    help="Maximum number of imports (of --groupsize file groups) before quitting. Default is 10000.",
+)
+@click.option(
+    "--imports-before-pausing",
+    default=250,
+    help="Number of imports (of --groupsize file groups) after which Photos is restarted. Default is 250.",
+)
 def main(photos_library_path, verbose, restart, groupsize, move_aae, max_imports, imports_before_pausing):
     """Repair photo bookmarks in a Photos sqlite database"""
     global _verbose
@@ -410,50 +648,50 @@ def main(photos_library_path, verbose, restart, groupsize, move_aae, max_imports
         click.echo(f"Found '{len(imported_bookmarks)}' already imported from previous run")
 
     to_import_set = set(referenced_files.values())
-    import_groups = list(make_import_groups(referenced_files.values(), imported_bookmarks))
+    # the set is for membership tests, group from a sorted list so files are imported in the same order every run
+    import_groups = list(make_import_groups(sorted(to_import_set), imported_bookmarks))
 
-    ntried = 0
     click.echo("Importing photos into temporary working library")
-    for filepath_groups in grouper_it(groupsize, import_groups):
-        filepaths = [fp for fplist in filepath_groups for fp in fplist]
-
-        to_import = []
-        moved_aae = []
-        for filepath in filepaths:
-            click.echo(f"Processing file {filepath}")
-            if not os.path.exists(filepath):
-                click.secho(
-                    f"Skipping missing file '{filepath}', cannot rewrite bookmarks for missing files.",
-                    err=True,
-                    fg="red",
-                )
-                continue
-            if filepath in imported_bookmarks:
-                if _verbose > 1:
-                    click.secho(f"... used previously imported '{filepath}'", fg="green")
-            else:
-                to_import.append(filepath)
-
-            if move_aae:
-                aaefile = move_aae_file_if_it_exists(filepath, dont_move_set=to_import_set)
-                if aaefile is not None:
-                    moved_aae.append(aaefile)
-
-        if len(to_import) > 0:
-            import_files_to_photos(to_import)
-            time.sleep(0.25)
-            ntried += 1
-            if len(moved_aae) > 0:
-                move_aae_files_back(moved_aae)
-            if ntried %imports_before_pausing == 0:
-                click.echo(f"Pausing after {imports_before_pausing} imports (total imports = {ntried})")
-                global_photoslib.quit()
-                time.sleep(4)
-                global_photoslib.activate()
-                time.sleep(8)
-            if ntried >= max_imports:
-                click.echo("Stopping after {max_imports} imports")
-                sys.exit(1)
+    batches = prepare_import_batches(import_groups, groupsize, imported_bookmarks, to_import_set, move_aae,
+                                     imports_before_pausing, max_imports)
+    # get the next batch ready in a worker thread while Photos imports the current one;
+    # the imports themselves stay on this thread as AppleScript has to run on the main thread
+    batch = next_batch = None
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_batch = executor.submit(next, batches, None)
+            while (batch := next_batch.result()) is not None:
+                to_import, moved_aae, ntried, messages = batch
+                next_batch = executor.submit(next, batches, None)
+                for message, styles in messages:
+                    click.secho(message, **styles)
+                if len(to_import) > 0:
+                    bookmark_count = _count_zfilesystem_bookmarks(temp_db_path)
+                    import_files_to_photos(to_import)
+                    wait_for_import(temp_db_path, bookmark_count + len(to_import))
+                if len(moved_aae) > 0:
+                    move_aae_files_back(moved_aae)
+                batch = None
+                if len(to_import) > 0 and ntried %imports_before_pausing == 0:
+                    click.echo(f"Pausing after {imports_before_pausing} imports (total imports = {ntried})")
+                    get_photoslib().quit()
+                    # don't reuse the connection to the Photos that was just quit
+                    reset_photoslib()
+                    time.sleep(4)
+                    get_photoslib().activate()
+                    time.sleep(8)
+                if ntried >= max_imports:
+                    click.echo(f"Stopping after {max_imports} imports")
+                    sys.exit(1)
+    finally:
+        # if an import failed or we stopped early, put back the AAE files still moved out of the way
+        # for the batch being imported and for the one prepared in the background
+        if batch is not None and len(batch[1]) > 0:
+            move_aae_files_back(batch[1])
+        if next_batch is not None and next_batch.exception() is None:
+            pending = next_batch.result()
+            if pending is not None and len(pending[1]) > 0:
+                move_aae_files_back(pending[1])
 
     click.confirm(
         "Please quit Photos.\n" "Type 'y' when you have done this.",
@@ -467,7 +705,7 @@ def main(photos_library_path, verbose, restart, groupsize, move_aae, max_imports
         )
 
     click.echo("Rewriting bookmarks in target library")
-    update_bookmarks_in_photos_database(referenced_files, photos_db_path, temp_db_path)
+    update_bookmarks_in_photos_database(referenced_files, photos_db_path, temp_db_path, to_import_set)
 
     click.confirm(
         f"Please open Photos while holding down the Option key then select your target library: {photos_library_path}\n"
@@ -483,6 +721,8 @@ def main(photos_library_path, verbose, restart, groupsize, move_aae, max_imports
             abort=True,
         )
 
+    # Photos was quit and reopened with a different library since the last connection
+    reset_photoslib()
     while verify_temp_library_signature():
         click.secho(
             "It appears the temporary Photos library is still open. Are you sure you opened the right library?",